@@ -4,8 +4,14 @@ __maintainer__ = "Sabina Przioda"
 __status__ = "Production"
 
 import datetime
+from functools import lru_cache
 from dateutil.relativedelta import relativedelta
+import bottleneck as bn
 import numpy as np
+from numba import njit, types
+
+# columns of prices which are stored as float32 in the investment plan
+PRICE_COLUMNS = ['Open', 'High', 'Low', 'Close', 'Adj Close', 'moving_max']
 
 def get_new_xticks_per_year(df):
     """
@@ -17,8 +23,9 @@ def get_new_xticks_per_year(df):
     Return:
     xticks - x axis ticks one per year
     """
-    years = df.groupby('year').Date.first().dt.year.values
-    xticks = np.concatenate(([np.datetime64(f'{years[0]-1}-01-01')], df.groupby('year').Date.first().values, [np.datetime64(f'{years[-1]+1}-01-01')], [np.datetime64(f'{years[-1]+2}-01-01')]))
+    first_dates = df.groupby('year').Date.first()
+    years = first_dates.dt.year.values
+    xticks = np.concatenate(([np.datetime64(f'{years[0]-1}-01-01')], first_dates.values, [np.datetime64(f'{years[-1]+1}-01-01')], [np.datetime64(f'{years[-1]+2}-01-01')]))
     
     return xticks
 
@@ -45,6 +52,16 @@ def get_start_and_end_of_history(etf_idx, etf_idx_dict):
     
     return start_date, end_date
 
+@lru_cache(maxsize=None)
+def _compute_horizon_start_end(start_date, year_start, horizon_length):
+    """
+    Cached date arithmetic of get_horizon_start_end. Every strategy and every grid search run loops over the same year_start values,
+    so each horizon is computed only once.
+    """
+    horizon_start = start_date + relativedelta(years=year_start)
+    horizon_end = horizon_start + relativedelta(years=horizon_length)
+    return horizon_start, horizon_end
+
 def get_horizon_start_end(start_date, year_start, horizon_length=20, verbose=1):
     """
     Get the start end end date of the e.g. 20 year horizon. By default the horizon_length is 20 years.
@@ -59,8 +76,7 @@ def get_horizon_start_end(start_date, year_start, horizon_length=20, verbose=1):
     horizon_start - horizon window start
     horizon_end - horizon window end
     """
-    horizon_start = start_date + relativedelta(years=year_start)
-    horizon_end = horizon_start + relativedelta(years=horizon_length)
+    horizon_start, horizon_end = _compute_horizon_start_end(start_date, year_start, horizon_length)
     if verbose == 1:
         print(horizon_start, horizon_end)
     return horizon_start, horizon_end
@@ -77,10 +93,8 @@ def compute_moving_max(df, window_size=125):
     df - Dataframe with an additional column called moving_max
     """
     # The rolling moving max is the maximum over a 6 months rolling window
-    df['moving_max'] = df.High.rolling(window_size).max()
-    # irerate through null values in moving_max (124 values) in reverse order
-    for i, (row_idx, row) in enumerate(df[df.moving_max.isnull()][::-1].iterrows()):
-        df.loc[row_idx, 'moving_max'] = df[df.moving_max.isnull()].High.max()
+    # with min_count=1 the first window_size-1 values are the maximum up to that day
+    df['moving_max'] = bn.move_max(df.High.to_numpy(), window=window_size, min_count=1)
         
     return df
 
@@ -97,114 +111,83 @@ def compute_percent_drop(df):
     df['percent_drop'] = 1 - df['Adj Close'] / df.moving_max
     return df
 
-def assign_available_capital(df, monthly_savings):
+def get_first_business_days(df):
     """
-    Assign the available capital. It's modeled as getting amount of money specified in monthly_savings each month at the first business day of the month.
+    Get the first business day of each month.
     
     Parameters:
-    df - Dataframe containing prices of the ETF
-    monthly_savings - int the amount of money able to save and invest each month
+    df - Dataframe containing prices of the ETF with Date as column sorted in ascending order
     
     Return:
-    df - Dataframe containing the information about the capital available to invest
+    first_business_days - bool array, True at the first business day of each month
     """
-    money_input = df.groupby(['year', 'month']).Date.first().to_frame()
-    money_input['capital'] = monthly_savings
-    df = df.merge(money_input, how='left', on='Date')
-    df.capital = df.capital.cumsum().fillna(method='ffill')
-    return df
+    # bucket the dates by month, a new month starts wherever the bucket changes
+    months = df.Date.to_numpy().astype('datetime64[M]')
+    first_business_days = np.ones(len(months), dtype=bool)
+    first_business_days[1:] = months[1:] != months[:-1]
+    return first_business_days
 
-def create_monthly_investment_plan(df, perc_monthly_invest):
-    """
-    Create the investment plan according to the monthly savings plan. Every first of the month shares are bought at the opening price for the amount of capital available at the time.
-    
-    Parameters:
-    df - Dataframe with all available information about prices, moving_max, percentage_drop
-    perc_monthly_invest - [0, 1] percentage of capital to invest on a monthly basis. For the monthly savings plan this is 1.0, for the market timing strategy
-                          this is 0.0
-    
-    Return:
-    df - investment plan showing True in the buy column if invested, the amount of investment and the updated cash
-    """
-    
-    try:
-        assert perc_monthly_invest >= 0 and perc_monthly_invest <= 1
-    except AssertionError as e:
-        e.args += (f'perc_monthly_invest must be within [0, 1] but is {perc_monthly_invest}', )
-        raise
-        
-    # buying_time contains all investments at the first business day of the month  
-    buying_time = df.groupby(['year', 'month']).Date.first().to_frame()
-    buying_time['buy'] = perc_monthly_invest > 0
-    buying_time['investment_percent'] = perc_monthly_invest
-    buying_time['investment_amount'] = df[df.capital.notnull()].capital.iloc[0]*perc_monthly_invest
-    # merge to the investmentplan of no invests the buying_time containing all times something is invested
-    df = df.merge(buying_time, how='left', on='Date').fillna(
-        {'buy': False, 'investment_percent': 0, 'investment_amount': 0})
-    # update the cash
-    df['cash'] = df.capital - df.investment_amount.cumsum()  
+# percent_drop and Open are only read by the kernel and may be read-only views of the dataframe columns
+_readonly_float32_array = types.Array(types.float32, 1, 'A', readonly=True)
+_readonly_bool_array = types.Array(types.boolean, 1, 'A', readonly=True)
 
-    return df
-
-def create_drop_threshold_investment_plan(df, mode, perc_drop_threshold, waiting_days, drop_multiplier):
+@njit(types.void(_readonly_bool_array, _readonly_float32_array, _readonly_float32_array, types.float64, types.float64, types.float64, types.int64, types.int64, 
+                 types.boolean, types.float32[:], types.boolean[:], types.float32[:], types.float32[:], types.float32[:], types.float32[:]), 
+      cache=True, boundscheck=False)
+def _simulate_investment_plan(first_business_days, percent_drop, open_price, monthly_savings, perc_monthly_invest, perc_drop_threshold, waiting_days, 
+                              drop_multiplier, use_drop_threshold, capital, buy, inv_pct, inv_amt, cash, share_amount):
     """
-    Create the investment plan according to the market timing strategy. Depending on the perc_drop_thershold if percent_drop is below that threshold, money is invested.
-    The percentage of cash invested is determiend by the product of percent_drop and drop_multiplier.
-    If the strategy is hybrid it's not possible to invest an additional amount on the same day the monthly savings plan is executed.
+    Numba kernel of determine_buy_and_investment_amount. Walks once through the investment horizon and fills the output arrays in place.
+    On the first business day of each month monthly_savings are added to the capital and perc_monthly_invest of them are invested.
+    If use_drop_threshold, money is additionally invested on the day after a percent_drop above perc_drop_threshold, 
+    as long as nothing is invested by the monthly investment on that day.
+    The capital and the cumulative investment are only tracked as scalars.
     
     Parameters:
-    df - Dataframe with all available information about prices, moving_max, percentage_drop
-    mode - {monthly_invest_strategy, markettiming_strategy, hybrid_strategy} strategy mode: One of the three investment strategies
-    perc_drop_threshold - [0, 1.0] the threshold for percent_drop to trigger a possible buy 
-    waiting_days - int > 0 minimum number of days between two buys triggered by the percent_drop
-    drop_multiplier - [1, inf) the multiplier for the percent_drop to determine the percentage of cash to invest
-    
-    Return:
-    df - investment plan showing True in the buy column if invested, the amount of investment and the updated cash
+    first_business_days - bool array, True at the first business day of each month
+    percent_drop - array of percent_drop
+    open_price - array of the opening prices
+    monthly_savings, perc_monthly_invest, perc_drop_threshold, waiting_days, drop_multiplier - see determine_buy_and_investment_amount
+    use_drop_threshold - bool, True if money is invested based on percent_drop
+    capital, buy, inv_pct, inv_amt, cash, share_amount - output arrays of the columns of the investment plan
     """
-    
-    try:
-        assert (perc_drop_threshold >= 0 and perc_drop_threshold <= 1.0)
-    except AssertionError as e:
-        e.args += (f'perc_drop_threshold must be within [0, 1.0] but is {perc_drop_threshold}', )
-        raise
-        
-    try:
-        assert (waiting_days >= 1 and type(waiting_days)==int)
-    except AssertionError as e:
-        e.args += (f'waiting_days must be an int but is {waiting_days}', )
-        raise
-        
-    try:
-        assert (drop_multiplier >= 1 and type(drop_multiplier)==int) 
-    except AssertionError as e:
-        e.args += (f'drop_multiplier must be an int but is {drop_multiplier}', )
-        raise
-    
     # initialize last_buy to be in the past such that it's possible to buy at the first possible time
     last_buy = -waiting_days
-    # buying after the last index in the investment_plan is not possible
-    last_idx = df.index[-1]
-    # determine whether to buy or not buy for each row based on percent_drop (of the previous day) and perc_drop_threshold 
-    for i, (row_idx, row) in enumerate(df[df.percent_drop>=perc_drop_threshold].iterrows()):
-        if row_idx - last_buy >= waiting_days and row_idx != last_idx:
-            # buy on the next day at the opening price
-            next_row_idx = row_idx + 1
-            # if hybrid_strategy then an investment at the first of the month is not possible, because it's anyway being invested due to the monthly investment
-            if mode == 'hybrid_strategy' and df.loc[next_row_idx].buy == True:
-                continue
-            df.loc[next_row_idx, 'buy'] = True
-            last_buy = row_idx
-            df.loc[next_row_idx, 'investment_percent'] = np.minimum(1, df.percent_drop.loc[row_idx] * drop_multiplier)
-            df.loc[next_row_idx, 'investment_amount'] = df.loc[next_row_idx].cash * df.loc[next_row_idx, 'investment_percent']
-            df.loc[next_row_idx:, 'cash'] = df.loc[next_row_idx:].cash - df.loc[next_row_idx].investment_amount 
-            
-    return df
+    total_capital = 0.0
+    total_invested = 0.0
+    for row_idx in range(len(percent_drop)):
+        buy[row_idx] = False
+        inv_pct[row_idx] = 0.0
+        inv_amt[row_idx] = 0.0
+        share_amount[row_idx] = 0.0
+        # every first of the month the monthly_savings are available and a percentage of them is invested
+        if first_business_days[row_idx]:
+            total_capital += monthly_savings
+            buy[row_idx] = perc_monthly_invest > 0
+            inv_pct[row_idx] = perc_monthly_invest
+            inv_amt[row_idx] = monthly_savings * perc_monthly_invest
+            total_invested += inv_amt[row_idx]
+        # determine whether to buy or not buy based on percent_drop of the previous day and perc_drop_threshold,
+        # an investment on the same day as the monthly investment is not possible, because it's anyway being invested
+        prev_row_idx = row_idx - 1
+        if (use_drop_threshold and prev_row_idx >= 0 and not buy[row_idx] and percent_drop[prev_row_idx] >= perc_drop_threshold 
+                and prev_row_idx - last_buy >= waiting_days):
+            # buy at the opening price
+            buy[row_idx] = True
+            last_buy = prev_row_idx
+            inv_pct[row_idx] = min(1.0, percent_drop[prev_row_idx] * drop_multiplier)
+            inv_amt[row_idx] = (total_capital - total_invested) * inv_pct[row_idx]
+            total_invested += inv_amt[row_idx]
+        if buy[row_idx]:
+            share_amount[row_idx] = inv_amt[row_idx] / open_price[row_idx]
+        capital[row_idx] = total_capital
+        cash[row_idx] = total_capital - total_invested
     
-def determine_buy_and_investment_amount(df, mode, perc_monthly_invest, perc_drop_threshold, waiting_days, drop_multiplier):
+def determine_buy_and_investment_amount(df, mode, perc_monthly_invest, perc_drop_threshold, waiting_days, drop_multiplier, monthly_savings):
     """
     Create the investment plan according to one of the three strategies (mode): monthly_invest_strategy|markettiming_strategy|hybrid_strategy.
-    The investment plan shows when is being invested and how much is invested.
+    The investment plan shows the capital available, when is being invested and how much is invested. 
+    The capital, the monthly investments and the investments triggered by the percent_drop are computed in a single pass by _simulate_investment_plan.
     
     Parameters:
     df - Dataframe with all available information about prices, moving_max, percentage_drop
@@ -214,33 +197,56 @@ def determine_buy_and_investment_amount(df, mode, perc_monthly_invest, perc_drop
     perc_drop_threshold - [0, 1.0] the threshold for percent_drop to trigger a possible buy 
     waiting_days - [1, inf) minimum number of days between two buys triggered by the percent_drop
     drop_multiplier - [1, inf) the multiplier for the percent_drop to determine the percentage of cash to invest
+    monthly_savings - int the amount of money able to save and invest each month
     
     Return:
-    df - investment plan showing True in the buy column if invested, the amount of investment, 
+    df - investment plan showing the capital, True in the buy column if invested, the amount of investment, 
          the updated cash and the share amount bought at that point in time
     """
     
     modes = ['monthly_invest_strategy', 'markettiming_strategy', 'hybrid_strategy']
-    try:
-        assert mode in modes
-    except AssertionError as e:
-        e.args += (f'mode must be one of the values {modes} but is {mode}', )
-        raise
+    if mode not in modes:
+        raise ValueError(f'mode must be one of the values {modes} but is {mode}')
         
     if mode == 'monthly_invest_strategy':
         perc_monthly_invest = 1.0
     elif mode == 'markettiming_strategy':
         perc_monthly_invest = 0.0
         
-    if perc_monthly_invest == 1.0:
-        df = create_monthly_investment_plan(df, perc_monthly_invest)
-    else:
-        df = create_monthly_investment_plan(df, perc_monthly_invest)
-        df = create_drop_threshold_investment_plan(df, mode, perc_drop_threshold, waiting_days, drop_multiplier)
+    if not (0 <= perc_monthly_invest <= 1):
+        raise ValueError(f'perc_monthly_invest must be within [0, 1] but is {perc_monthly_invest}')
         
-    df['investment_percent'] = df.investment_percent.fillna(0)
-    df['investment_amount'] = df.investment_amount.fillna(0)
-    df['share_amount'] = df.investment_amount/df.Open
+    # if the full capital is invested monthly there is no cash left to invest based on the percent_drop
+    use_drop_threshold = perc_monthly_invest != 1.0
+    if use_drop_threshold:
+        if not (0 <= perc_drop_threshold <= 1.0):
+            raise ValueError(f'perc_drop_threshold must be within [0, 1.0] but is {perc_drop_threshold}')
+            
+        if not (waiting_days >= 1 and type(waiting_days)==int):
+            raise ValueError(f'waiting_days must be an int >= 1 but is {waiting_days}')
+            
+        if not (drop_multiplier >= 1 and type(drop_multiplier)==int):
+            raise ValueError(f'drop_multiplier must be an int >= 1 but is {drop_multiplier}')
+    else:
+        # the drop threshold parameters are unused, pass neutral placeholders matching the signature of the kernel
+        perc_drop_threshold, waiting_days, drop_multiplier = 1.0, 1, 1
+            
+    n_rows = len(df)
+    capital = np.empty(n_rows, dtype=np.float32)
+    buy = np.empty(n_rows, dtype=bool)
+    investment_percent = np.empty(n_rows, dtype=np.float32)
+    investment_amount = np.empty(n_rows, dtype=np.float32)
+    cash = np.empty(n_rows, dtype=np.float32)
+    share_amount = np.empty(n_rows, dtype=np.float32)
+    _simulate_investment_plan(get_first_business_days(df), df.percent_drop.to_numpy(dtype=np.float32), df.Open.to_numpy(dtype=np.float32), monthly_savings, 
+                              perc_monthly_invest, perc_drop_threshold, waiting_days, drop_multiplier, use_drop_threshold, 
+                              capital, buy, investment_percent, investment_amount, cash, share_amount)
+    df['capital'] = capital
+    df['buy'] = buy
+    df['investment_percent'] = investment_percent
+    df['investment_amount'] = investment_amount
+    df['cash'] = cash
+    df['share_amount'] = share_amount
     
     return df
 
@@ -260,7 +266,7 @@ def create_investment_plan(df, start_date, year_start, horizon_length, mode, mon
                      The rest is left as cash and can be invested depending on the perc_drop_threshold and waiting_days.
                      
     Parameters:
-    df - Dataframe containing the data from the pandas datareader
+    df - Dataframe containing the data from the pandas datareader, sorted by its DatetimeIndex
     start_date - datetime start_date of the index
     year_start - int offset in years to the horizon start
     horizon_length - int length of the horizon window. Default is 20 years
@@ -277,11 +283,19 @@ def create_investment_plan(df, start_date, year_start, horizon_length, mode, mon
     investment_plan - investment plan showing True in the buy column if invested, the amount of investment, 
                       the updated cash and the share amount bought at that point in time
     """
+    if not df.index.is_monotonic_increasing:
+        raise ValueError('df must be sorted by its DatetimeIndex')
+        
     horizon_start, horizon_end = get_horizon_start_end(start_date, year_start, horizon_length, verbose)
-    df_horizon = df.loc[horizon_start:horizon_end].reset_index()
+    # binary search of the horizon in the sorted index, horizon_end is included like in df.loc[horizon_start:horizon_end]
+    start_idx = df.index.searchsorted(horizon_start)
+    end_idx = df.index.searchsorted(horizon_end, side='right')
+    # float32 precision is sufficient for prices and amounts and halves the memory traffic of all following computations
+    df_horizon = df.iloc[start_idx:end_idx].reset_index()
+    df_horizon = df_horizon.astype({col: np.float32 for col in PRICE_COLUMNS if col in df_horizon})
     df_horizon = compute_percent_drop(df_horizon)
-    investment_plan = assign_available_capital(df_horizon, monthly_savings)
-    investment_plan = determine_buy_and_investment_amount(investment_plan, mode, perc_monthly_invest, perc_drop_threshold, waiting_days, drop_multiplier)
+    investment_plan = determine_buy_and_investment_amount(df_horizon, mode, perc_monthly_invest, perc_drop_threshold, waiting_days, drop_multiplier, 
+                                                          monthly_savings)
     
     return investment_plan
 
@@ -298,8 +312,11 @@ def compute_roi(investment_plan):
     win_per_year - the difference between portfolio and amount invested per year
     roi_per_year - the return of invest per year in percent
     """
-    portfolio_per_year = investment_plan.groupby('year').share_amount.sum().cumsum()*investment_plan.groupby('year').Open.tail(1).values
-    amount_invested_per_year = investment_plan.groupby('year').investment_amount.sum().cumsum()
+    # one groupby pass for all KPIs, Open is the last opening price of each year
+    kpis_per_year = investment_plan.groupby('year').agg(share_amount=('share_amount', 'sum'), investment_amount=('investment_amount', 'sum'), 
+                                                        Open=('Open', 'last'))
+    portfolio_per_year = kpis_per_year.share_amount.cumsum()*kpis_per_year.Open.values
+    amount_invested_per_year = kpis_per_year.investment_amount.cumsum()
     win_per_year = portfolio_per_year - amount_invested_per_year
     roi_per_year = win_per_year/amount_invested_per_year
     